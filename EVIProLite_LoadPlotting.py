@@ -14,6 +14,8 @@ from requests.packages.urllib3.exceptions import InsecureRequestWarning
 requests.packages.urllib3.disable_warnings(InsecureRequestWarning)
 from datetime import datetime,timedelta
 import os
+import time
+import threading
 import logging
 from retrying import retry
 
@@ -134,8 +136,8 @@ def csv_run(input_csv, api_key, smoothing = 1, **kwargs):
             if val not in param_dict[list(param_dict)[col_idx]]:#param_series[col_idx]:
                 if col_idx==2: #Find closest temperature rather than throwing an error
                     nearest_temp = find_nearest(param_dict['temp_c'],val)
-                    logging.debug("Scenario "+str(row_id)+" temperature: "+str(val))
-                    logging.debug("Nearest value: "+str(nearest_temp))
+                    logging.debug("Scenario %s temperature: %s", row_id, val)
+                    logging.debug("Nearest value: %s", nearest_temp)
                     row[col_idx] = nearest_temp
                 else:
                     logging.warning("Invalid input row index "+str(row_id)+", column index "+str(col_idx)+ (": "+param_dict[list(param_dict)[col_idx]]))
@@ -146,6 +148,13 @@ def csv_run(input_csv, api_key, smoothing = 1, **kwargs):
     return output_dict
 
 
+#Build the daily load profile API url for one set of parameters
+def build_url(api_key,fleet_size,mean_dvmt,temp_c,pev_type,pev_dist,class_dist,home_access_dist,home_power_dist,work_power_dist,pref_dist,res_charging,work_charging):
+    base_url = """https://developer.nrel.gov/api/evi-pro-lite/v1/daily-load-profile?api_key=%s&""" %(api_key)
+    url = base_url+"""fleet_size=%s&mean_dvmt=%s&temp_c=%s&pev_type=%s&pev_dist=%s&class_dist=%s&home_access_dist=%s&home_power_dist=%s&work_power_dist=%s&pref_dist=%s&res_charging=%s&work_charging=%s""" \
+        %(fleet_size,mean_dvmt,temp_c,pev_type,pev_dist,class_dist,home_access_dist,home_power_dist,work_power_dist,pref_dist,res_charging,work_charging)
+    return url.replace("\\", "")
+
 #This function is called by temp_apply and returns output from the API based on the row sent by temp_apply
 def API_run(df_row, api_key, smoothing, **kwargs): 
     # Get county name for the run
@@ -154,19 +163,16 @@ def API_run(df_row, api_key, smoothing, **kwargs):
     #if csv_temp parameter is defined, that means it is passed in via csv. Must replace temp_c with that value based on available temps defined for the tool
     if len(df_row)==15:
         date,weekday,temp_c,fleet_size,mean_dvmt,pev_type,pev_dist,class_dist,home_access_dist,home_power_dist,work_power_dist,pref_dist,res_charging,work_charging,scenario_id = df_row
-        logging.info(f'{date} - {county}')
+        logging.info('%s - %s', date, county)
     else:
         fleet_size,mean_dvmt,temp_c,pev_type,pev_dist,class_dist,home_access_dist,home_power_dist,work_power_dist,pref_dist,res_charging,work_charging = df_row
     temp_c = find_nearest(param_dict["temp_c"],temp_c)
     #day_of_week and dest_type are used to generate plots- therefore these cannot be set manually
     #Generate load profiles for home, public, and work on both weekends and weekdays and for different charger levels according to the selected parameters
-    base_url = """https://developer.nrel.gov/api/evi-pro-lite/v1/daily-load-profile?api_key=%s&""" %(api_key)
-    url = base_url+"""fleet_size=%s&mean_dvmt=%s&temp_c=%s&pev_type=%s&pev_dist=%s&class_dist=%s&home_access_dist=%s&home_power_dist=%s&work_power_dist=%s&pref_dist=%s&res_charging=%s&work_charging=%s""" \
-        %(fleet_size,mean_dvmt,temp_c,pev_type,pev_dist,class_dist,home_access_dist,home_power_dist,work_power_dist,pref_dist,res_charging,work_charging)
-    url=url.replace("\\", "")
+    url = build_url(api_key,fleet_size,mean_dvmt,temp_c,pev_type,pev_dist,class_dist,home_access_dist,home_power_dist,work_power_dist,pref_dist,res_charging,work_charging)
 
     try:
-        record_str = make_request(url).text
+        record_str = make_request(url, get_rate_limiter(api_key)).text
     except Exception as e:
         logging.error(f"Failed to make request: {str(e)}")
         raise
@@ -179,7 +185,7 @@ def API_run(df_row, api_key, smoothing, **kwargs):
         if 'error' in raw_json:
             logging.error("ERROR:"+raw_json['error']['code'])
             if "API" in raw_json['error']['code']:
-                logging.error(f"API key: {api_key}\n")
+                logging.error("API key ending in %s\n", api_key[-4:])
             raise
         elif 'errors' in raw_json:
             logging.error("ERROR:"+raw_json['errors'][0]+"\n")
@@ -199,9 +205,88 @@ def API_run(df_row, api_key, smoothing, **kwargs):
         result = pd.DataFrame(raw_json['results'])
     return result
 
-@retry(stop_max_attempt_number=5, wait_fixed=2000)  # Retry 5 times with a 2-second delay between retries
-def make_request(url):
-    response = requests.get(url)
+#Client-side token bucket for a single API key. NREL throttles each key to 1 call per second
+#and 1,000 calls per hour and reports the hourly limit and remaining quota in the response
+#headers, so calls are paced to spread the full quota over the window instead of retrying
+#blindly on 429
+class RateLimiter:
+    def __init__(self, max_rate=1.0, window=3600):
+        self.max_rate = max_rate #calls per second
+        self.rate = max_rate
+        self.window = window #seconds over which X-RateLimit-Limit is replenished
+        self.window_start = None #time of the first call in the current window
+        self.tokens = 1.0
+        self.last = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = threading.Lock()
+
+    #Block until a call is allowed, then consume a token
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(1.0, self.tokens+(now-self.last)*self.rate)
+                self.last = now
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    if self.window_start is None or now-self.window_start >= self.window:
+                        self.window_start = now
+                    return
+                wait = max(self.blocked_until-now, (1-self.tokens)/self.rate)
+            time.sleep(wait)
+
+    #Pace at X-RateLimit-Limit per window. Only when X-RateLimit-Remaining reaches 0 (e.g. the
+    #key is shared with another client) hold off until the window started by the first call
+    #resets. On 429, wait exactly Retry-After if given
+    def update(self, response):
+        with self.lock:
+            now = time.monotonic()
+            limit = response.headers.get('X-RateLimit-Limit')
+            if limit is not None and limit.isdigit() and int(limit) > 0:
+                self.rate = min(self.max_rate, int(limit)/self.window)
+            remaining = response.headers.get('X-RateLimit-Remaining')
+            if remaining is not None and remaining.isdigit() and int(remaining) == 0:
+                reset = (self.window_start if self.window_start is not None else now)+self.window
+                self.blocked_until = max(self.blocked_until, reset)
+                self.window_start = None
+            if response.status_code == 429:
+                self.tokens = 0.0
+                retry_after = response.headers.get('Retry-After')
+                if retry_after is not None and retry_after.isdigit():
+                    self.blocked_until = now+int(retry_after)
+                else:
+                    self.blocked_until = max(self.blocked_until, now+1/self.rate)
+
+#One rate limiter per API key so a throttled key does not hold back calls made with other keys
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+def get_rate_limiter(api_key):
+    with rate_limiters_lock:
+        if api_key not in rate_limiters:
+            rate_limiters[api_key] = RateLimiter()
+        return rate_limiters[api_key]
+
+#Raised when a key is still throttled after the limiter waited for it max_throttled times
+class RateLimitExhausted(Exception):
+    pass
+
+#Retry 5 times with a 2-second delay between retries. Exhausted rate limits are not retried, the limiter already waited
+@retry(stop_max_attempt_number=5, wait_fixed=2000, retry_on_exception=lambda e: not isinstance(e, RateLimitExhausted))
+def make_request(url, limiter=None, max_throttled=5):
+    #429s are not retried blindly here: the limiter schedules the next attempt from the response headers
+    for attempt in range(max_throttled):
+        if limiter is not None:
+            limiter.acquire()
+        response = requests.get(url)
+        if limiter is None:
+            break
+        limiter.update(response)
+        if response.status_code != 429:
+            break
+        logging.warning("Received 429 too many requests, waiting for the rate limit to reset")
+    else:
+        raise RateLimitExhausted(f"Received 429 too many requests {max_throttled} times in a row")
     if response.status_code >= 500:
         raise Exception(f"Received {response.status_code} server error")
     elif response.status_code >= 400 and response.status_code != 429:
@@ -209,6 +294,22 @@ def make_request(url):
     # Add more conditions for specific error codes if needed
     return response
 
+#Make a single call with the given key, paced by its rate limiter, to check that it is valid and not
+#out of quota before a long run
+#Returns the HTTP status code of the call (403: invalid key, 429: rate limit exceeded),
+#or None if the call itself failed (e.g. no connection or timeout) so the caller can decide what to do
+def check_api_key(api_key, timeout=30):
+    url = build_url(api_key,*[values[0] for values in param_dict.values()])
+    limiter = get_rate_limiter(api_key)
+    limiter.acquire()
+    try:
+        response = requests.get(url, timeout=timeout)
+        limiter.update(response)
+        return response.status_code
+    except requests.RequestException as e:
+        logging.warning("Could not check API key: %s", e)
+        return None
+
 #Return nearest value in array to single input value
 def find_nearest(array, value):
     array = np.asarray(array)
@@ -289,9 +390,12 @@ def notemp_loadPlotting(result,scenario, dow,filename = ""):
 #plots data from startdate forward or from the first day of data forward if no startdate supplied
 #startdate in yyyy-mm-dd format
 #Plots forward numdays number of days (default is to plot one week)
-def csvPlotting(path,startdate = "",numdays = 7,filename = ""):
+#For csvs holding several scenarios (scenario column), plots only the given scenario
+def csvPlotting(path,startdate = "",numdays = 7,filename = "",scenario = None):
     
     result = pd.read_csv(path)
+    if scenario is not None and 'scenario' in result.columns:
+        result = result[result.scenario==scenario].reset_index(drop=True)
     figlen = 12+len(result)/1000
     fig = plt.figure(figsize = (figlen,7))
     ax = plt.axes()
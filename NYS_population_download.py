@@ -4,32 +4,57 @@
 import os
 import sys
 import time
-import requests
+import asyncio
+import aiohttp
 import logging
-import concurrent.futures
-import threading
 
-thread_local = threading.local()
+# Retry throttled and server errors, connection errors and timeouts
+# a few times with exponential backoff
+RETRY_STATUS = {429, 500, 502, 503, 504}
+MAX_RETRIES = 3
+BACKOFF_FACTOR = 0.5
 
 # %% Downloader functions
 
-def get_session():
-    """Create a thread-local session object"""
-    if not hasattr(thread_local, "session"):
-        thread_local.session = requests.Session()
-    return thread_local.session
-
-def download_site(url):
-
-    session = get_session()
-    with session.get(url) as response:
-        # Write the result to a file
-        with open(os.path.join(data_dir, f"{url.split('=')[-1]}.xlsx"), 'wb') as f:
-            f.write(response.content)
-
-def download_all_sites(sites):
-    with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
-        executor.map(download_site, sites)
+async def download_site(session, sem, item):
+
+    county_id, url = item
+    async with sem:
+        for attempt in range(MAX_RETRIES + 1):
+            try:
+                async with session.get(url) as response:
+                    if response.status in RETRY_STATUS and attempt < MAX_RETRIES:
+                        await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+                        continue
+                    response.raise_for_status()
+                    # Stream the result to a file
+                    with open(os.path.join(data_dir, f"{county_id}.xlsx"), 'wb') as f:
+                        async for chunk in response.content.iter_chunked(64 * 1024):
+                            f.write(chunk)
+                    return
+            except aiohttp.ClientResponseError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError):
+                if attempt == MAX_RETRIES:
+                    raise
+                await asyncio.sleep(BACKOFF_FACTOR * 2 ** attempt)
+
+async def download_all_sites(sites):
+    # All downloads hit the same host, so one event loop and one
+    # keep-alive connection pool serve every request
+    sem = asyncio.Semaphore(10)
+    connector = aiohttp.TCPConnector(limit=10, limit_per_host=10, ttl_dns_cache=300)
+    timeout = aiohttp.ClientTimeout(total=30)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        results = await asyncio.gather(*[download_site(session, sem, item) for item in sites],
+                                       return_exceptions=True)
+    n_downloaded = 0
+    for (county_id, url), result in zip(sites, results):
+        if isinstance(result, Exception):
+            logging.error('Failed to download %s: %s', url, result)
+        else:
+            n_downloaded += 1
+    return n_downloaded
 
 
 if __name__ == "__main__":
@@ -53,11 +78,10 @@ if __name__ == "__main__":
     # Set base url
     base_url = 'https://pad.human.cornell.edu/counties/expprojdata.cfm?'
 
-    # Create a list of urls to download
-    urls = [f'{base_url}county={id}' for id in range(1, 125, 2)]
+    # Create a list of (county id, url) pairs to download
+    items = [(cid, f'{base_url}county={cid}') for cid in range(1, 125, 2)]
 
     start_time = time.time()
-    download_all_sites(urls)
+    n_downloaded = asyncio.run(download_all_sites(items))
     duration = time.time() - start_time
-    print(f"Downloaded {len(urls)} in {duration} seconds")
-
+    print(f"Downloaded {n_downloaded} of {len(items)} in {duration} seconds")
@@ -1,18 +1,35 @@
 # example_ny_ev_proj.py
 # Example of EV charging demand projection for New York State.
-# This is a multithreading version of example_ny_ev_proj.ipynb.
+# This is a multiprocessing version of example_ny_ev_proj.ipynb.
 
 # %% Import packages
 
 import os
 import sys
+import argparse
+import multiprocessing
+import multiprocessing.util
 import numpy as np
 import pandas as pd
-from EVIProLite_LoadPlotting import (temp_run, loadPlotting)
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import matplotlib
+matplotlib.use('Agg')  # Render figures off-screen from the plotting thread
+from EVIProLite_LoadPlotting import (temp_run, loadPlotting, check_api_key)
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing.shared_memory import SharedMemory
+from itertools import cycle
+import queue
+import threading
 import time
 import logging
 
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# Daily temperature shared by the worker processes, set by init_worker
+shared_shm = None
+shared_temps = None
+shared_dates = None
+shared_weekdays = None
+
 
 def county_run(temp_csv, scenario_csv, api_key, county):
     """
@@ -36,37 +53,326 @@ def county_run(temp_csv, scenario_csv, api_key, county):
     """
 
     # Handle temperature data
-    temp_csv['date'] = pd.to_datetime(temp_csv['date']).dt.date
+    dt = pd.to_datetime(temp_csv['date'])
     # Saturday and Sunday are 5 and 6, Monday is 0. <5 is weekday
-    temp_csv['weekday'] = temp_csv['date'].apply(lambda x: x.weekday())  # <5)
-    temp_csv['temp_c'] = temp_csv['temperature']
-    temp_csv.drop('temperature', axis=1, inplace=True)
+    # temp_run expects the columns in the order date, weekday, temp_c
+    temp_csv = pd.DataFrame({
+        'date': dt.dt.date.to_numpy(),
+        'weekday': dt.dt.weekday.to_numpy(dtype=np.int8),
+        'temp_c': temp_csv['temperature'].to_numpy(dtype=np.float32),
+    }, copy=False)
+
+    return county_run_daily(temp_csv, scenario_csv, api_key, county)
+
+
+def county_run_daily(temp_csv, scenario_csv, api_key, county):
+    """
+    Run the EVI-Pro Lite model for a county on prepared temperature data.
+
+    Parameters
+    ----------
+    temp_csv : pandas.DataFrame
+        Daily temperature data with date, weekday and temp_c columns,
+        in that order.
+    scenario_csv : pandas.DataFrame
+        Scenario data.
+    api_key : str
+        NREL API key.
+    county : str
+        County name.
+
+    Returns
+    -------
+    final_result : pandas.DataFrame
+        15 min EV charging demand.
+    """
 
     # Handle small fleet size
-    scaling_factor = np.ones(len(scenario_csv))
-    for scenario, row in scenario_csv.iterrows():
-        if row['fleet_size'] < 30000:
-            scenario_csv.loc[scenario, 'fleet_size'] = 10000
-            scaling_factor[scenario] = row['fleet_size'] / 10000
-            logging.warning(
-                f"Scenario {scenario}: Fleet size of {county} is too small: {row['fleet_size']}.")
-            logging.warning(
-                f"Set fleet size to 10000 and scale the results by {scaling_factor[scenario]}.")
+    fleet = scenario_csv['fleet_size'].to_numpy(copy=True)
+    mask = fleet < 30000
+    scaling_factor = np.where(mask, fleet / 10000.0, 1.0)
+    for i in np.flatnonzero(mask):
+        logging.warning("Scenario %s: Fleet size of %s is too small: %s.",
+                        scenario_csv.index[i], county, fleet[i])
+        logging.warning("Set fleet size to 10000 and scale the results by %s.", scaling_factor[i])
+    scenario_csv.loc[mask, 'fleet_size'] = 10000
 
     # Run the model
-    logging.debug(f'Running with API key: {api_key}')
+    logging.debug('Running the model for %s', county)
     final_result = temp_run(scenario_csv, temp_csv, api_key, county=county)
 
     # Scale the results
-    for scenario, row in scenario_csv.iterrows():
-        if scaling_factor[scenario] != 1:
-            final_result[scenario][['home_l1', 'home_l2', 'work_l1', 'work_l2', 'public_l2', 'public_l3']] = \
-                final_result[scenario][['home_l1', 'home_l2', 'work_l1', 'work_l2', 'public_l2', 'public_l3']] * \
-                scaling_factor[scenario]
+    load_cols = ['home_l1', 'home_l2', 'work_l1', 'work_l2', 'public_l2', 'public_l3']
+    for i in np.flatnonzero(scaling_factor != 1):
+        final_result[scenario_csv.index[i]][load_cols] *= scaling_factor[i]
 
     return final_result
 
 
+def init_worker(shm_name, shape, dtype, dates, weekdays):
+    """
+    Set up logging in a worker process and attach it to the shared daily
+    temperature matrix.
+
+    Forkserver workers import this script as __mp_main__, so the logging
+    set up in the __main__ block does not run there.
+
+    Parameters
+    ----------
+    shm_name : str
+        Name of the shared memory block.
+    shape : tuple
+        Shape of the matrix, (days, counties).
+    dtype : str
+        Data type of the matrix.
+    dates : numpy.ndarray
+        Date of each row of the matrix.
+    weekdays : numpy.ndarray
+        Day of the week of each row of the matrix, Monday is 0.
+
+    Returns
+    -------
+    None.
+    """
+
+    global shared_shm, shared_temps, shared_dates, shared_weekdays
+
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=LOG_FORMAT)
+    logging.captureWarnings(True)
+
+    shared_shm = SharedMemory(name=shm_name)
+    shared_temps = np.ndarray(shape, dtype=dtype, buffer=shared_shm.buf)
+    shared_dates = dates
+    shared_weekdays = weekdays
+
+    # Detach from the block when the worker process exits
+    multiprocessing.util.Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    """
+    Detach a worker process from the shared daily temperature matrix.
+
+    Returns
+    -------
+    None.
+    """
+
+    global shared_temps
+    shared_temps = None
+    shared_shm.close()
+
+
+def county_run_shared(col_idx, rows, scenario_csv, api_key, county):
+    """
+    Run the EVI-Pro Lite model for a county on the shared daily temperature.
+
+    Parameters
+    ----------
+    col_idx : int
+        Column of the county in the shared temperature matrix.
+    rows : numpy.ndarray
+        Rows (days) of the shared temperature matrix to run.
+    scenario_csv : pandas.DataFrame
+        Scenario data.
+    api_key : str
+        NREL API key.
+    county : str
+        County name.
+
+    Returns
+    -------
+    final_result : pandas.DataFrame
+        15 min EV charging demand.
+    """
+
+    temp_csv = pd.DataFrame({
+        'date': shared_dates[rows],
+        'weekday': shared_weekdays[rows],
+        'temp_c': shared_temps[rows, col_idx],
+    }, copy=False)
+    return county_run_daily(temp_csv, scenario_csv, api_key, county)
+
+
+def key_worker(api_key, bucket, executor, results):
+    """
+    Run the tasks assigned to one API key, one county at a time.
+
+    Parameters
+    ----------
+    api_key : str
+        NREL API key.
+    bucket : list of tuple
+        (col_idx, rows, scenario_csv, county) tasks assigned to the key.
+    executor : concurrent.futures.Executor
+        Single worker process that runs county_run_shared for this key.
+    results : queue.Queue
+        Receives (county, scenario_csv, final_result, error) for each task.
+
+    Returns
+    -------
+    None.
+    """
+
+    for col_idx, rows, scenario_csv, county in bucket:
+        try:
+            final_result = executor.submit(county_run_shared, col_idx, rows, scenario_csv,
+                                           api_key, county).result()
+            results.put((county, scenario_csv, final_result, None))
+        except Exception as e:
+            results.put((county, scenario_csv, None, e))
+
+
+def save_county_results(final_result, scenario_csv, county, month, fig_dir, output_dir):
+    """
+    Plot and save the EV charging demand of a county.
+
+    All scenarios are saved to a single CSV file with scenario and
+    timestamp columns, readable by csvPlotting.
+
+    Parameters
+    ----------
+    final_result : dict of pandas.DataFrame
+        15 min EV charging demand by scenario, as returned by county_run.
+    scenario_csv : pandas.DataFrame
+        Scenario data.
+    county : str
+        County name.
+    month : int
+        Month of the run.
+    fig_dir : str
+        Figure directory.
+    output_dir : str
+        Output directory.
+
+    Returns
+    -------
+    None.
+    """
+
+    for scenario, row in scenario_csv.iterrows():
+        # Plot charging demand for the first week
+        # NOTE: loadPlotting closes its figure after saving it
+        fig_name = os.path.join(fig_dir,
+                                f'{county}_month{month}_scen{str(scenario)}_temp_gridLoad.png'.replace(' ', '_'))
+        loadPlotting(final_result, scenario, fig_name)
+
+    # Save charging demand of all scenarios in one file
+    combined = pd.concat({scenario: final_result[scenario] for scenario in scenario_csv.index},
+                         names=['scenario', 'timestamp'])
+    filename = os.path.join(output_dir,
+                            f'{county}_month{month}_temp_gridLoad.csv'.replace(' ', '_'))
+    combined.to_csv(filename, chunksize=100_000)
+
+    logging.info('Finished running for county: %s', county)
+
+
+def plot_worker(plot_q, month, fig_dir, output_dir, errors):
+    """
+    Plot and save county results taken from a queue until a None sentinel.
+
+    Parameters
+    ----------
+    plot_q : queue.Queue
+        Yields (county, scenario_csv, final_result, error) from key_worker.
+    month : int
+        Month of the run.
+    fig_dir : str
+        Figure directory.
+    output_dir : str
+        Output directory.
+    errors : list
+        Collects the errors of failed counties.
+
+    Returns
+    -------
+    None.
+    """
+
+    while True:
+        item = plot_q.get()
+        if item is None:
+            break
+        county, scenario_csv, final_result, error = item
+        try:
+            if error is None:
+                save_county_results(final_result, scenario_csv, county, month, fig_dir, output_dir)
+        except Exception as e:
+            error = e
+        if error is not None:
+            logging.error('Failed to run county %s: %s', county, error)
+            errors.append(error)
+
+
+def write_csv_if_changed(df, path):
+    """
+    Save a DataFrame to CSV unless the file already holds identical content.
+
+    Parameters
+    ----------
+    df : pandas.DataFrame
+        Data to save.
+    path : str
+        CSV file path.
+
+    Returns
+    -------
+    written : bool
+        True if the file was (re)written.
+    """
+
+    content = df.to_csv()
+    if os.path.isfile(path):
+        with open(path, 'r', newline='') as f:
+            if f.read() == content:
+                return False
+    with open(path, 'w', newline='') as f:
+        f.write(content)
+    return True
+
+
+def read_daily_temperature(src_csv, cache_path):
+    """
+    Read daily average temperature by county from the hourly ResStock data.
+
+    The parsed and resampled data is cached as a feather file, which is
+    reused as long as it is newer than the source CSV.
+
+    Parameters
+    ----------
+    src_csv : str
+        Hourly temperature CSV with columns named "NY, <county>".
+    cache_path : str
+        Feather cache file path.
+
+    Returns
+    -------
+    temp_df_daily : pandas.DataFrame
+        Daily average temperature with one column per county.
+    """
+
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) > os.path.getmtime(src_csv):
+        logging.info('Read daily temperature from cache: %s', cache_path)
+        temp_df_daily = pd.read_feather(cache_path)
+        return temp_df_daily.set_index(temp_df_daily.columns[0])
+
+    temp_df = pd.read_csv(src_csv, index_col=0, parse_dates=True)
+
+    # Parse county names and rename columns
+    county_names = [county.split(',')[1] for county in temp_df.columns]
+    county_names = [county.strip() for county in county_names]
+    temp_df.columns = county_names
+
+    # Calculate daily average temperature
+    temp_df_daily = temp_df.resample('D').mean()
+
+    os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+    temp_df_daily.reset_index().to_feather(cache_path)
+    logging.info('Saved daily temperature to cache: %s', cache_path)
+
+    return temp_df_daily
+
+
 def population_density_2_dvmt(population_density):
 
     p2d = {'99': 35, '499': 25, '999': 25, '1999': 25,
@@ -95,11 +401,18 @@ def population_density_2_dvmt(population_density):
 
 
 if __name__ == '__main__':
+    # %% Parse arguments
+
+    parser = argparse.ArgumentParser(
+        description='EV charging demand projection for New York State.')
+    parser.add_argument('--skip-scenario-dump', action='store_true',
+                        help='Do not save the scenario data of each county to CSV.')
+    args = parser.parse_args()
+
     # %% Set up logging
 
     start = time.time()
-    logging.basicConfig(level=logging.INFO, stream=sys.stdout,
-                        format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.basicConfig(level=logging.INFO, stream=sys.stdout, format=LOG_FORMAT)
     logging.captureWarnings(True)
 
     # %% Set up directories
@@ -144,7 +457,7 @@ if __name__ == '__main__':
                 if line.strip() and len(line.strip()) == 40:
                     api_key_list.append(line.strip())
                 else:
-                    logging.warning(f'Invalid API key: {line.strip()}')
+                    logging.warning('Invalid API key ending in %s', line.strip()[-4:])
         n_api_key = len(api_key_list)
         if n_api_key > 0:
             logging.info(f'{n_api_key} API keys found in file.')
@@ -171,6 +484,18 @@ if __name__ == '__main__':
             api_key_list.append(api_key)
             n_api_key = 1
 
+    # Fail fast on keys that are rejected or already out of quota
+    # NOTE: Keys that could not be checked (no connection) are kept.
+    for api_key in list(api_key_list):
+        status = check_api_key(api_key)
+        if status in (403, 429):
+            logging.warning('API key ending in %s returned %s and is skipped.', api_key[-4:], status)
+            api_key_list.remove(api_key)
+    n_api_key = len(api_key_list)
+    if n_api_key == 0:
+        logging.critical('No usable API key. Please check your API keys or wait for the rate limit to reset.')
+        sys.exit()
+
     # %% Read vehicle count data
 
     scenario = 'AP_Recommendations'
@@ -198,103 +523,133 @@ if __name__ == '__main__':
 
     # %% Read temperature data
 
-    # Hourly air temperature data in 2018 from NREL ResStock
-    temp_df = pd.read_csv(os.path.join(input_dir, 'resstock_amy2018_temp.csv'),
-                          index_col=0, parse_dates=True)
-
-    # Parse county names and rename columns
-    county_names = [county.split(',')[1] for county in temp_df.columns]
-    county_names = [county.strip() for county in county_names]
-    temp_df.columns = county_names
-
-    # Calculate daily average temperature
-    temp_df_daily = temp_df.resample('D').mean()
-
-    # Loop through the months
-    # NOTE: This is only for reducing computational cost.
-    months = range(1, 13)
-    for m in months:
-        temp_df_daily_m = temp_df_daily[temp_df_daily.index.month == m] # type: ignore
-
-        # %% Run the model
-
-        # Loop through the first three counties
-        # NOTE: NREL throttles the API calls to 1 call per second.
-        #       A user can make at most 1,000 calls per hour.
-        temp_csv_list = list()
-        scenario_csv_list = list()
-
-        for county in county_names:
-            # Get daily average temperature for the county
-            temp_csv = pd.DataFrame(temp_df_daily_m[county]).reset_index()
-            temp_csv.columns = ['date', 'temperature']
-            # temp_csv['date'] = pd.to_datetime(temp_csv['date'])
-            temp_csv_list.append(temp_csv)
-
-            # Get scenario data for the county
-            fleet_size = vehicle_by_county_proj_year[county]
-            temp_c = temp_csv['temperature'].mean()
-
-            pop_dens = pop_dens_county[pop_dens_county['County']
-                                       == county]['Population_density'].values[0]
-            mean_dvmt = population_density_2_dvmt(pop_dens)
-
-            # Example scenario: two PHEV types
-            # User can change the scenario data here
-            scenario_dict = {
-                'fleet_size': [fleet_size] * 2,
-                'mean_dvmt': [mean_dvmt] * 2,
-                'temp_c': [temp_c] * 2,
-                'pev_type': ['PHEV50'] * 2,
-                'pev_dist': ['EQUAL'] * 2,
-                'class_dist': ['Equal'] * 2,
-                'home_access_dist': ['HA100'] * 2,
-                'home_power_dist': ['Equal'] * 2,
-                'work_power_dist': ['MostL2'] * 2,
-                'pref_dist': ['Home100'] * 2,
-                'res_charging': ['min_delay', 'max_delay'],
-                'work_charging': ['min_delay'] * 2,
-            }
-            scenario_csv = pd.DataFrame(scenario_dict)
-            # Save scenario data to CSV
-            scenario_csv.to_csv(os.path.join(
-                scenario_dir, f'{county}_month{m}_scenarios.csv'.replace(' ', '_')))
-            scenario_csv_list.append(scenario_csv)
-
-        # %% Set up a thread pool with 10 threads
-        with ThreadPoolExecutor(max_workers=10) as executor:
-
-            futures = list()
-            for i, (temp_csv, scenario_csv) in enumerate(zip(temp_csv_list, scenario_csv_list)):
-                # Switch to the next API key for every call
-                api_key_index = i % n_api_key
-                api_key = api_key_list[api_key_index]
-
-                # Submit the task to the executor with the assigned API key
-                futures.append(executor.submit(county_run, temp_csv, scenario_csv, api_key, county_names[i]))
-
-            for i, future in enumerate(as_completed(futures)):
-                final_result = future.result()
-
-                # Plotting and Save CSVs with data
-                county = county_names[i]
-                scenario_csv = scenario_csv_list[i]
-
-                for scenario, row in scenario_csv.iterrows():
-                    # Plot charging demand for the first week
-                    fig_name = os.path.join(fig_dir,
-                                            f'{county}_month{m}_scen{str(scenario)}_temp_gridLoad.png'.replace(' ',
-                                                                                                               '_'))
-                    loadPlotting(final_result, scenario, fig_name)
-
-                    # Save charging demand to CSV
-                    filename = os.path.join(output_dir,
-                                            f'{county}_month{m}_scen{str(scenario)}_temp_gridLoad.csv'.replace(' ',
-                                                                                                               '_'))
-                    final_result[scenario].to_csv(filename)
-
-                logging.info(f'Finished running for county: {county}')
-        logging.info(f'Finished running the model for month {m}.')
+    # Hourly air temperature data in 2018 from NREL ResStock,
+    # averaged by day and cached for later runs
+    temp_df_daily = read_daily_temperature(os.path.join(input_dir, 'resstock_amy2018_temp.csv'),
+                                           os.path.join(input_dir, '.cache', 'resstock_daily.feather'))
+    county_names = list(temp_df_daily.columns)
+
+    # Row positions of each month in the daily temperature
+    month_rows = temp_df_daily.groupby(temp_df_daily.index.month).indices # type: ignore
+
+    # Start the workers from a minimal forkserver process where available,
+    # so they do not inherit a copy of the main process memory
+    mp_context = multiprocessing.get_context(
+        'forkserver' if 'forkserver' in multiprocessing.get_all_start_methods() else None)
+
+    # Fleet size and mean DVMT of each county do not change between months
+    fleet_sizes = vehicle_by_county_proj_year.to_dict()
+    pop_dens_by_county = pop_dens_county.set_index('County')['Population_density'].to_dict()
+    mean_dvmts = {county: population_density_2_dvmt(pop_dens_by_county[county])
+                  for county in county_names}
+
+    # Example scenario: two PHEV types
+    # User can change the scenario data here
+    # NOTE: fleet_size, mean_dvmt and temp_c are set for each county and month.
+    #       Keep the column order, temp_run reads the columns by position.
+    scenario_template = pd.DataFrame({
+        'fleet_size': [0] * 2,
+        'mean_dvmt': [0] * 2,
+        'temp_c': [0.0] * 2,
+        'pev_type': ['PHEV50'] * 2,
+        'pev_dist': ['EQUAL'] * 2,
+        'class_dist': ['Equal'] * 2,
+        'home_access_dist': ['HA100'] * 2,
+        'home_power_dist': ['Equal'] * 2,
+        'work_power_dist': ['MostL2'] * 2,
+        'pref_dist': ['Home100'] * 2,
+        'res_charging': ['min_delay', 'max_delay'],
+        'work_charging': ['min_delay'] * 2,
+    })
+
+    # Put the daily temperature in shared memory once, so the worker
+    # processes read it in place instead of unpickling it for every county
+    temps = temp_df_daily.to_numpy(dtype=np.float32)
+    shm = SharedMemory(create=True, size=temps.nbytes)
+    executors = list()
+    try:
+        np.ndarray(temps.shape, dtype=temps.dtype, buffer=shm.buf)[:] = temps
+        # Saturday and Sunday are 5 and 6, Monday is 0. <5 is weekday
+        initargs = (shm.name, temps.shape, 'float32', temp_df_daily.index.date,
+                    temp_df_daily.index.weekday.to_numpy(dtype=np.int8))
+
+        # %% Set up one worker process per API key
+        # NOTE: Each task runs on its own interpreter so the pandas work in
+        #       temp_run is not serialized by the GIL. Pinning each key to one
+        #       long-lived process keeps its rate limiter, and what the limiter
+        #       learned from the response headers, in a single place for the
+        #       whole run.
+        executors = [ProcessPoolExecutor(max_workers=1, mp_context=mp_context,
+                                         initializer=init_worker, initargs=initargs)
+                     for _ in api_key_list]
+
+        # Loop through the months
+        # NOTE: This is only for reducing computational cost.
+        months = range(1, 13)
+        for m in months:
+            # Mean temperature of each county in the month
+            temp_c_m = temp_df_daily.iloc[month_rows[m]].mean()
+
+            # %% Run the model
+
+            # Loop through the first three counties
+            # NOTE: NREL throttles the API calls to 1 call per second.
+            #       A user can make at most 1,000 calls per hour.
+            scenario_csv_list = list()
+
+            for county in county_names:
+                # Get scenario data for the county
+                fleet_size = fleet_sizes[county]
+                mean_dvmt = mean_dvmts[county]
+                temp_c = temp_c_m[county]
+
+                scenario_csv = scenario_template.copy()
+                scenario_csv['fleet_size'] = fleet_size
+                scenario_csv['mean_dvmt'] = mean_dvmt
+                scenario_csv['temp_c'] = temp_c
+                # Save scenario data to CSV, skipping files that are already up to date
+                if not args.skip_scenario_dump:
+                    write_csv_if_changed(scenario_csv, os.path.join(
+                        scenario_dir, f'{county}_month{m}_scenarios.csv'.replace(' ', '_')))
+                scenario_csv_list.append(scenario_csv)
+
+            # %% Assign counties to API keys in turn
+            # NOTE: Each key has its own worker thread running one county at a
+            #       time, so every key is used fully but never over its quota.
+            buckets = [list() for _ in range(n_api_key)]
+            for bucket, (col_idx, (scenario_csv, county)) in zip(cycle(buckets),
+                                                                  enumerate(zip(scenario_csv_list, county_names))):
+                bucket.append((col_idx, month_rows[m], scenario_csv, county))
+
+            # Completed counties are plotted and saved while the model runs
+            # for the others
+            # NOTE: pyplot keeps global state, so figures are rendered by a single
+            #       thread.
+            plot_q = queue.Queue(maxsize=32)
+            errors = list()
+            plotter = threading.Thread(target=plot_worker, args=(plot_q, m, fig_dir, output_dir, errors),
+                                       daemon=True)
+            plotter.start()
+
+            workers = [threading.Thread(target=key_worker, args=(api_key, bucket, executor, plot_q),
+                                        daemon=True)
+                       for api_key, bucket, executor in zip(api_key_list, buckets, executors)]
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+
+            plot_q.put(None)
+            plotter.join()
+            if errors:
+                raise errors[0]
+
+            logging.info('Finished running the model for month %s.', m)
+    finally:
+        for executor in executors:
+            executor.shutdown()
+        shm.close()
+        shm.unlink()
 
     end = time.time()
     logging.info('#############################################')